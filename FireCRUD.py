@@ -1,26 +1,44 @@
+import threading
+import time
+
 import requests
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import config
 
-def retrieve_authToken():
+# API Essentials
+authAPI_endPoint_signIn = 'https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key='
+authAPI_endPoint_refresh = 'https://securetoken.googleapis.com/v1/token?key='
+
+# One pooled session for all calls to Google, so that the TCP/TLS handshake is paid once.
+# Transient server errors are retried; the POSTs here only exchange credentials for a token.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504],
+        allowed_methods=frozenset(["POST"]), raise_on_status=False)
+))
+TIMEOUT = (3.05, 5)
+
+# The bearer token is valid for an hour (see 'expiresIn'), so share it across calls
+# and renew it only when it is within the refresh margin of expiry.
+_token_cache = {"idToken": None, "exp": 0.0, "refreshToken": None}
+_token_lock = threading.Lock()
+REFRESH_MARGIN_SECONDS = 30
+
+def sign_in():
     """
-    Executes a POST request to obatin a bearer token from Firebase auth services.
-    Uses the API key for the Firebase project. This key belongs to the project owner.
-    It must be kept secure at all times. 
+    Executes a POST request to sign in to Firebase auth services with the owner's credentials.
 
     args: None
-    returns: reponse (json) that has the bearer token on success
-    usage: bearer_token = get_authToken()['idToken']
+    returns: response (json) that has the bearer token on success
     """
-    response = None
-
-    # API Essentials
-    authAPI_endPoint_signIn = 'https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key='
     API_KEY=config.GoogleServices_API_KEY
 
     # Collect data for making HTTP request
     URL = authAPI_endPoint_signIn + API_KEY
-    print(URL)
     payload = {
         "email": config.email,
         "password": config.password,
@@ -28,8 +46,77 @@ def retrieve_authToken():
     }
 
     # Make request
-    r_auth = requests.post(URL, json=payload)
-    response = r_auth.json()
+    r_auth = _session.post(URL, json=payload, timeout=TIMEOUT)
+    return r_auth.json()
+
+def refresh_authToken(refresh_token: str):
+    """
+    Exchanges a refresh token for a new bearer token with Google secure token service.
+    This is cheaper than signing in with the password all over again.
+
+    args: refresh_token from an earlier sign-in or refresh
+    returns: response (json) with keys renamed to match the sign-in response
+    """
+    URL = authAPI_endPoint_refresh + config.GoogleServices_API_KEY
+    payload = {
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token
+    }
+
+    r_refresh = _session.post(URL, data=payload, timeout=TIMEOUT)
+    response = r_refresh.json()
+    if "id_token" not in response:
+        return response
+    return {
+        "idToken": response["id_token"],
+        "refreshToken": response["refresh_token"],
+        "expiresIn": response["expires_in"]
+    }
+
+def cached_authToken():
+    """
+    Returns the cached bearer token if it is not about to expire, or None.
+    Never waits on the lock or the network, so it is safe to call from the event loop.
+    The expiry is written last on refresh, so a fresh expiry always comes with its token.
+
+    args: None
+    returns: dict with 'idToken' or None
+    """
+    token = dict(_token_cache)
+    if time.monotonic() < token["exp"] - REFRESH_MARGIN_SECONDS:
+        return token
+    return None
+
+def retrieve_authToken():
+    """
+    Obtains a bearer token from Firebase auth services.
+    Uses the API key for the Firebase project. This key belongs to the project owner.
+    It must be kept secure at all times.
+    Executes the steps as follows:
+    1. Returns the cached token if it is not about to expire.
+    2. Otherwise renews the token with the refresh token, if there is one.
+    3. Falls back to signing in with the password when the refresh fails.
+    4. Caches the token with its expiry on success.
+
+    args: None
+    returns: reponse (json) that has the bearer token on success
+    usage: bearer_token = get_authToken()['idToken']
+    """
+    with _token_lock:
+        if time.monotonic() < _token_cache["exp"] - REFRESH_MARGIN_SECONDS:
+            return dict(_token_cache)
+
+        response = None
+        if _token_cache["refreshToken"]:
+            try:
+                response = refresh_authToken(_token_cache["refreshToken"])
+            except (requests.RequestException, ValueError):
+                response = None
+        if not response or "idToken" not in response:
+            response = sign_in()
 
-    return response
-    
\ No newline at end of file
+        if "idToken" in response:
+            _token_cache["idToken"] = response["idToken"]
+            _token_cache["refreshToken"] = response.get("refreshToken")
+            _token_cache["exp"] = time.monotonic() + int(response["expiresIn"])
+        return response
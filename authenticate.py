@@ -1,8 +1,21 @@
 import crud
 
+from fastapi.concurrency import run_in_threadpool
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Argon2 hashes new passwords; bcrypt hashes are still verified and upgraded on next login.
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__time_cost=2,
+    argon2__memory_cost=65536,
+    argon2__parallelism=2,
+    bcrypt__rounds=10,
+)
+
+# Verified against when the username is unknown, so that a miss takes as long as a wrong password
+# and response times do not reveal which emails are registered.
+DUMMY_HASH = pwd_context.hash("bimba-dummy-password")
 
 def verify_password(password, password_hashed):
     return pwd_context.verify(password, password_hashed)
@@ -10,20 +23,28 @@ def verify_password(password, password_hashed):
 def get_hashed_password(password):
     return pwd_context.hash(password)
 
-def authenticate_grahaka(db, username:str, password: str):
+async def authenticate_grahaka(db, username:str, password: str):
     """
     AUthenticate the grahak in the following steps:
-    1. Check that the username (email) exists in the database. 
+    1. Check that the username (email) exists in the database, spending the same effort either way. 
     2. Retrieve the grahak's profile from database and verify password.
-    3. Return the grahaka object.
+    3. Re-hash the password with the preferred scheme if the stored hash is outdated.
+    4. Return the grahaka's credentials row (id, email, password_hashed, is_active).
+    The password hashing runs in the threadpool,
+    so that the event loop serves other requests while the hash is computed.
     Refer to:
     - crud.py for CRUD operations on the database.
-    - models.py for class of the returned object.
+    - models.py for columns of the returned row.
     """
-    grahaka = crud.get_grahaka_by_email(db, username)
+    grahaka = await crud.get_grahaka_credentials_by_email(db, username)
     if not grahaka:
+        await run_in_threadpool(verify_password, password, DUMMY_HASH)
         return False
-    if not verify_password(password, grahaka.password_hashed):
+    verified, password_rehashed = await run_in_threadpool(
+        pwd_context.verify_and_update, password, grahaka.password_hashed)
+    if not verified:
         return False
+    if password_rehashed:
+        await crud.update_grahaka_password(db, grahaka.id, password_rehashed)
     return grahaka
 
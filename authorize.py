@@ -1,11 +1,32 @@
+import base64
+import hmac
+import json
+import time
+
 import config
-from jose import JWTError, jwt
+import jwt
 from typing import Optional
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 SECRET_KEY=config.SECRET_KEY
 ALGORITHM=config.ALGORITHM
-ACCESS_TOKEN_EXPIRES_MINUTES=config.ALGORITHM
+ACCESS_TOKEN_EXPIRES_MINUTES=config.ACCESS_TOKEN_EXPIRES_MINUTES
+
+# Every HS256 token carries the same header, so encode it once.
+HEADER_HS256 = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+SECRET_KEY_BYTES = SECRET_KEY.encode() if isinstance(SECRET_KEY, str) else SECRET_KEY
+
+def encode_HS256(payload: dict):
+    """
+    Signs the payload as a compact HS256 JWT without going through jwt.encode:
+    base64url(header).base64url(payload).base64url(HMAC-SHA256 of the first two parts).
+    base64 (binascii) and the one-shot hmac.digest both run in C.
+    Tokens decode with jwt.decode like any other.
+    """
+    payload_b64 = base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).rstrip(b"=")
+    signing_input = HEADER_HS256 + b"." + payload_b64
+    signature = hmac.digest(SECRET_KEY_BYTES, signing_input, "sha256")
+    return (signing_input + b"." + base64.urlsafe_b64encode(signature).rstrip(b"=")).decode()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """
@@ -14,15 +35,17 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     The validiity defaults to 20 minutes unless otherwise specified.
     Implements teh steps as follows:
     1. Makes a copy of the dictionary with username.
-    2. Calculates the expiry timestaamp after checking whether default has override.
+    2. Calculates the expiry as seconds since the epoch after checking whether default has override.
     3. Adds the expiry timestamp to the dictionary to encode.
-    4. Encodes and returns the token.
+    4. Encodes and returns the token, with the precomputed header for HS256.
     """
     to_encode = data.copy()
     if expires_delta:
-        expiry = datetime.utcnow() + expires_delta
+        expiry = int(time.time() + expires_delta.total_seconds())
     else:
-        expiry = datetime.utcnow() + timedelta(minutes=20)
+        expiry = int(time.time()) + 1200
     to_encode.update({"exp": expiry})
+    if ALGORITHM == "HS256":
+        return encode_HS256(to_encode)
     encoded_jwt = jwt.encode(to_encode, key=SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
\ No newline at end of file
+    return encoded_jwt
@@ -1,4 +1,9 @@
-from sqlalchemy.orm import Session
+from typing import List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, insert, update, delete, exists
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 import models, schemas
 import authenticate
@@ -7,62 +12,149 @@ import authenticate
 #   - Single user by ID or email
 #   - Multiple users
 #   - Multiple items
+# Grahaka records are served with their items (see schemas.Grahaka),
+# so the items are loaded up front in one extra query rather than one per grahaka.
+
+async def get_grahaka_by_ID(db: AsyncSession, grahaka_id: int):
+    stmt = select(models.Grahaka).options(selectinload(models.Grahaka.items)).where(models.Grahaka.id == grahaka_id)
+    return (await db.execute(stmt)).scalars().first()
+
+async def get_grahaka_by_email(db: AsyncSession, email: str):
+    stmt = select(models.Grahaka).where(models.Grahaka.email == email)
+    return (await db.execute(stmt)).scalars().first()
+
+async def get_grahaka_version(db: AsyncSession, grahaka_id: int):
+    # Everything that decides whether the grahaka's records have changed, in one narrow row.
+    stmt = select(models.Grahaka.id, models.Grahaka.email, models.Grahaka.row_version,
+        models.Grahaka.is_active, models.Grahaka.is_admin).where(models.Grahaka.id == grahaka_id)
+    return (await db.execute(stmt)).first()
 
-def get_grahaka_by_ID(db: Session, grahaka_id: int):
-    return db.query(models.Grahaka).filter(models.Grahaka.id == grahaka_id).first()
+async def get_grahaka_credentials_by_email(db: AsyncSession, email: str):
+    # Only the columns needed to sign in, without building the ORM object.
+    stmt = select(models.Grahaka.id, models.Grahaka.email, models.Grahaka.password_hashed, models.Grahaka.is_active)\
+        .where(models.Grahaka.email == email)
+    return (await db.execute(stmt)).first()
 
-def get_grahaka_by_email(db: Session, email: str):
-    return db.query(models.Grahaka).filter(models.Grahaka.email == email).first()
+async def exists_grahaka_by_email(db: AsyncSession, email: str):
+    stmt = select(exists().where(models.Grahaka.email == email))
+    return (await db.execute(stmt)).scalar()
 
-def get_grahaka(db: Session, skip: int=0, limit: int=99):
-    return db.query(models.Grahaka).offset(skip).limit(limit).all()
+async def get_grahaka(db: AsyncSession, skip: int=0, limit: int=99):
+    stmt = select(models.Grahaka).options(selectinload(models.Grahaka.items)).offset(skip).limit(limit)
+    return (await db.execute(stmt)).scalars().all()
 
-def get_patra_by_ID(db: Session, patra_id: int):
-    return db.query(models.Patra).filter(models.Patra.id == patra_id).first()
+async def get_patra_by_ID(db: AsyncSession, patra_id: int):
+    stmt = select(models.Patra).where(models.Patra.id == patra_id)
+    return (await db.execute(stmt)).scalars().first()
 
-def get_patra(db: Session, skip: int=0, limit: int=99):
-    return db.query(models.Patra).offset(skip).limit(limit).all()
+async def get_patra_for_deletion(db: AsyncSession, patra_id: int, grahaka_id: Optional[int], is_admin: bool=False):
+    # The row fetch_and_delete_patra would remove, read first so that its image can go before it does.
+    patra = models.Patra.__table__
+    stmt = select(patra).where(patra.c.id == patra_id)
+    if not is_admin:
+        stmt = stmt.where(patra.c.owner_id == grahaka_id)
+    return (await db.execute(stmt)).first()
 
-def get_patra_for_grahaka(db: Session, grahaka_id: int, skip: int=0, limit: int=99):
-    return db.query(models.Patra).filter(models.Patra.owner_id == grahaka_id).offset(skip).limit(limit).all()
+# Listings of patra are read-only, so they select from the table and return plain rows
+# (attribute access like patra.image still works) instead of building ORM objects.
+
+async def get_patra(db: AsyncSession, skip: int=0, limit: int=99):
+    stmt = select(models.Patra.__table__).offset(skip).limit(limit)
+    return (await db.execute(stmt)).all()
+
+async def get_patra_for_grahaka(db: AsyncSession, grahaka_id: int, skip: int=0, limit: int=99):
+    stmt = select(models.Patra.__table__).where(models.Patra.owner_id == grahaka_id).offset(skip).limit(limit)
+    return (await db.execute(stmt)).all()
+
+async def get_patra_for_grahaka_by_tags(db: AsyncSession, grahaka_id: int, tags: List[str], skip: int=0, limit: int=99):
+    # A patra matches when it carries every tag; each tag is looked up in patra_tag.
+    patra = models.Patra.__table__
+    patra_tag = models.PatraTag.__table__
+    stmt = select(patra).where(patra.c.owner_id == grahaka_id)
+    for tag in dict.fromkeys(tags):
+        stmt = stmt.where(patra.c.id.in_(select(patra_tag.c.patra_id).where(patra_tag.c.tag == tag)))
+    stmt = stmt.offset(skip).limit(limit)
+    return (await db.execute(stmt)).all()
     
 
+# Every write to a grahaka's patra also bumps the grahaka's row_version in the same transaction.
+
+def bump_grahaka_version(grahaka_id: int):
+    return update(models.Grahaka).where(models.Grahaka.id == grahaka_id)\
+        .values(row_version=models.Grahaka.row_version + 1)
+
+async def insert_patra_tags(db: AsyncSession, patras):
+    rows = [{"patra_id": patra.id, "tag": tag} for patra in patras for tag in models.split_tags(patra.tags)]
+    if rows:
+        await db.execute(insert(models.PatraTag), rows)
+
 # Create (Crud)
 
-def create_grahaka(db: Session, grahaka: schemas.GrahakaCreate):
-    password_hashed = authenticate.get_hashed_password(grahaka.password)
-    grahaka_DB = models.Grahaka(email=grahaka.email, is_active=True, is_admin=False, password_hashed=password_hashed)
+async def create_grahaka(db: AsyncSession, grahaka: schemas.GrahakaCreate):
+    password_hashed = await run_in_threadpool(authenticate.get_hashed_password, grahaka.password)
+    # A new grahaka has no items; saying so spares a lazy load when the record is serialized.
+    grahaka_DB = models.Grahaka(email=grahaka.email, is_active=True, is_admin=False, password_hashed=password_hashed,
+        items=[])
     db.add(grahaka_DB)
-    db.commit()
-    db.refresh(grahaka_DB)
+    await db.commit()
     return grahaka_DB
 
-def create_patra_for_grahaka(db: Session, patra: schemas.PatraCreate, grahaka_id: int):
+async def create_patra_for_grahaka(db: AsyncSession, patra: schemas.PatraCreate, grahaka_id: int):
     patra_DB = models.Patra(**patra.dict(), owner_id=grahaka_id)
     db.add(patra_DB)
-    db.commit()
-    db.refresh(patra_DB)
+    await db.flush()
+    await insert_patra_tags(db, [patra_DB])
+    await db.execute(bump_grahaka_version(grahaka_id))
+    await db.commit()
     return patra_DB
 
+async def create_patras_for_grahaka(db: AsyncSession, patras: List[schemas.PatraCreate], grahaka_id: int):
+    # Many patra in one INSERT and one commit, rather than a commit per patra.
+    rows = [{**patra.dict(), "owner_id": grahaka_id} for patra in patras]
+    patras_DB = (await db.scalars(insert(models.Patra).returning(models.Patra), rows)).all()
+    await insert_patra_tags(db, patras_DB)
+    await db.execute(bump_grahaka_version(grahaka_id))
+    await db.commit()
+    return patras_DB
+
+# Update (crUd)
+
+async def update_grahaka_password(db: AsyncSession, grahaka_id: int, password_hashed: str):
+    stmt = update(models.Grahaka).where(models.Grahaka.id == grahaka_id).values(password_hashed=password_hashed)
+    await db.execute(stmt, execution_options={"synchronize_session": False})
+    await db.commit()
+
 # Delete (cruD)
 
-def delete_grahaka(db: Session, grahaka_id: int):
-    grahaka_DB = db.query(models.Grahaka).filter(models.Grahaka.id == grahaka_id).first()
+async def delete_grahaka(db: AsyncSession, grahaka_id: int):
+    # One DELETE for all of the grahaka's patra and one for the grahaka, in one transaction,
+    # instead of a DELETE per patra. The record is detached first so it can still be returned.
+    grahaka_DB = await get_grahaka_by_ID(db, grahaka_id)
     if grahaka_DB:
-        db.delete(grahaka_DB)
-        db.commit()
+        db.expunge(grahaka_DB)
+        await db.execute(delete(models.PatraTag).where(models.PatraTag.patra_id.in_(
+            select(models.Patra.id).where(models.Patra.owner_id == grahaka_id))))
+        await db.execute(delete(models.Patra).where(models.Patra.owner_id == grahaka_id))
+        await db.execute(delete(models.Grahaka).where(models.Grahaka.id == grahaka_id))
+        await db.commit()
     return grahaka_DB
 
-def delete_patra_for_grahaka(db: Session, grahaka_id: int, patra_id: int):
-    patra_DB = db.query(models.Patra).filter(models.Grahaka.id == grahaka_id, models.Patra.id == patra_id).first()
+async def fetch_and_delete_patra(db: AsyncSession, patra_id: int, grahaka_id: Optional[int], is_admin: bool=False):
+    # A single DELETE that hands back the removed row, or None if there is no such patra
+    # or it belongs to another grahaka and the caller is not an admin.
+    patra = models.Patra.__table__
+    stmt = delete(patra).where(patra.c.id == patra_id)
+    if not is_admin:
+        stmt = stmt.where(patra.c.owner_id == grahaka_id)
+    patra_DB = (await db.execute(stmt.returning(*patra.c))).first()
     if patra_DB:
-        db.delete(patra_DB)
-        db.commit()
+        await db.execute(delete(models.PatraTag).where(models.PatraTag.patra_id == patra_DB.id))
+        await db.execute(bump_grahaka_version(patra_DB.owner_id))
+    await db.commit()
     return patra_DB
 
-def delete_patra(db: Session, patra_id: int):
-    patra_DB = db.query(models.Patra).filter(models.Patra.id == patra_id).first()
-    if patra_DB:
-        db.delete(patra_DB)
-        db.commit()
-    return patra_DB
\ No newline at end of file
+async def delete_patra_for_grahaka(db: AsyncSession, grahaka_id: int, patra_id: int):
+    return await fetch_and_delete_patra(db, patra_id, grahaka_id)
+
+async def delete_patra(db: AsyncSession, patra_id: int):
+    return await fetch_and_delete_patra(db, patra_id, None, is_admin=True)
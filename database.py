@@ -1,12 +1,10 @@
-from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
-BIMBADB_URL = "sqlite:///./data/bimba.db"
+BIMBADB_URL = "sqlite+aiosqlite:///./data/bimba.db"
 
-engine = create_engine(
-    BIMBADB_URL, connect_args = {"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(BIMBADB_URL, pool_size=20, max_overflow=40, pool_recycle=3600)
+# Objects keep their state after commit, so a freshly created record is returned without a refresh SELECT.
+SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
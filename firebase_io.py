@@ -0,0 +1,97 @@
+import logging
+from urllib.parse import quote
+
+import httpx
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from requests.exceptions import HTTPError
+
+import FireCRUD
+
+logger = logging.getLogger(__name__)
+
+# Grahaka's content goes to the project folder 'stash', in a sub-folder per grahaka.
+url2fire = 'https://firebasestorage.googleapis.com/v0/b/shiva-923e9.appspot.com/o/stash%2F'
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+async def get_fire_token():
+    """
+    Obtains the bearer token for Firebase storage.
+    FireCRUD keeps the token until it is about to expire; only a refresh, which goes over the network,
+    is sent to the threadpool.
+
+    args: None
+    returns: dict with 'idToken'
+    raises: HTTPException when no token is to be had
+    """
+    try:
+        fire_token = FireCRUD.cached_authToken() or await run_in_threadpool(FireCRUD.retrieve_authToken)
+    except HTTPError as errHTTP:
+        raise HTTPException(status_code=404, detail=f'Got no token from Firebase. See: {errHTTP}')
+    except Exception as err:
+        raise HTTPException(status_code=404, detail=f'Got no auth token. See: {err}')
+    # A failed sign-in comes back as Google's error response, which has no token.
+    if "idToken" not in fire_token:
+        raise HTTPException(status_code=404, detail=f'Got no auth token. See: {fire_token.get("error")}')
+    logger.debug("Got a Firebase token.")
+    return fire_token
+
+def upload_size(upload: UploadFile):
+    # The upload is spooled to memory or a temporary file, so seeking to the end is cheap.
+    upload.file.seek(0, 2)
+    size = upload.file.tell()
+    upload.file.seek(0)
+    return size
+
+async def read_chunks(upload: UploadFile):
+    # Streams the upload in chunks instead of reading the whole file into memory.
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+async def upload(http: httpx.AsyncClient, bimba: UploadFile, folder: str) -> str:
+    """
+    Uploads a file to the folder on Firebase storage, streaming it in chunks.
+
+    args: shared HTTP client, the uploaded file, the folder (grahaka's email)
+    returns: URL of the stored image, with its download token
+    raises: HTTPException when the upload fails
+    """
+    fire_token = await get_fire_token()
+    url2file = url2fire + quote(folder, safe='') + "%2F" + bimba.filename.replace(" ", "_")
+    headers = {
+        "Content-Type": bimba.content_type,
+        "Content-Length": str(upload_size(bimba)),
+        "Authorization": "Bearer "+fire_token["idToken"]
+    }
+    try:
+        r = await http.post(url2file, content=read_chunks(bimba), headers=headers)
+        r.raise_for_status()
+    except httpx.HTTPStatusError as errHTTP:
+        raise HTTPException(status_code=404, detail=f'Uploaded no image to Firebase. See: {errHTTP}')
+    except Exception as err:
+        raise HTTPException(status_code=404, detail=f'Posted no image to Firebase. See: {err}')
+    response = r.json()
+    logger.debug("Uploaded %s to Firebase.", response.get("name"))
+    return url2file + '?alt=media&token=' + response["downloadTokens"]
+
+async def delete(http: httpx.AsyncClient, image_url: str) -> None:
+    """
+    Removes an image from Firebase storage.
+
+    args: shared HTTP client, URL of the image as stored with the patra
+    returns: None
+    raises: HTTPException when the image is not removed
+    """
+    fire_token = await get_fire_token()
+    headers = {"Authorization": "Bearer "+fire_token["idToken"]}
+    try:
+        r = await http.delete(image_url, headers=headers)
+        r.raise_for_status()
+    except httpx.HTTPStatusError as errHTTP:
+        raise HTTPException(status_code=404, detail=f'Removed no image from Firebase. See: {errHTTP}.')
+    except Exception as err:
+        raise HTTPException(status_code=404, detail=f'Removed no image. See: {err}.')
@@ -1,47 +1,196 @@
-from typing import List, Optional
+from typing import List, Optional, NamedTuple
 from datetime import datetime, timedelta
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
 
-from fastapi import FastAPI, Depends, HTTPException, status, Path, Query, File, UploadFile, Response, Header, Cookie
+from fastapi import FastAPI, Depends, HTTPException, status, Path, Query, File, UploadFile, Response, Header, Cookie, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import HTMLResponse
-from sqlalchemy.orm import Session
-from jose import JWTError, jwt
+from fastapi.responses import HTMLResponse, ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+import jwt
+from jwt import PyJWTError
 from jinja2 import Environment, FileSystemLoader
-import requests
-from requests.exceptions import HTTPError
-from urllib.parse import quote
+from cachetools import TTLCache, TLRUCache
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 
 import models, crud, schemas
 import database
 import config
 import authenticate
 import authorize
-import FireCRUD
+import firebase_io
 
 from database import SessionLocal, engine
 
-models.Base.metadata.create_all(bind=engine)
-
 oauth2scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.on_event("startup")
+async def open_http_client():
+    # One client for all calls to Firebase storage, so that connections are pooled and kept alive.
+    app.state.http = httpx.AsyncClient(timeout=30)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
+@app.on_event("startup")
+async def size_threadpool():
+    # run_in_threadpool hands work to the loop's default executor: password hashing, token checks
+    # and Firebase sign-in. Each argon2 hash holds 64 MiB, so the size is left to the deployment.
+    workers = os.getenv("THREADPOOL_WORKERS")
+    if workers:
+        asyncio.get_event_loop().set_default_executor(ThreadPoolExecutor(max_workers=int(workers)))
+
+@app.on_event("startup")
+async def create_schema():
+    # Tables are created only when asked to, so that workers of a deployed app skip the round trips.
+    # The migrations always run: an existing database cannot be served without them.
+    async with engine.begin() as conn:
+        if os.getenv("AUTO_CREATE_SCHEMA") == "1":
+            await conn.run_sync(models.Base.metadata.create_all)
+        await conn.run_sync(models.migrate)
+
+class GrahakaIdentity(NamedTuple):
+    # The logged-in grahaka as handed to path operations, detached from any session.
+    id: int
+    email: str
+    is_active: bool
+    is_admin: bool
+
+# Grahaka looked up by email, so that authenticated requests skip the database on repeat visits.
+# Entries are dropped when the grahaka is created or removed, and expire after a minute otherwise.
+grahaka_cache = TTLCache(maxsize=5_000, ttl=60)
+grahaka_cache_lock = threading.Lock()
+
+async def get_grahaka_cached(db: AsyncSession, email: str):
+    with grahaka_cache_lock:
+        grahaka = grahaka_cache.get(email)
+    if grahaka is None:
+        grahaka_DB = await crud.get_grahaka_by_email(db, email)
+        if not grahaka_DB:
+            return None
+        grahaka = GrahakaIdentity(grahaka_DB.id, grahaka_DB.email, grahaka_DB.is_active, grahaka_DB.is_admin)
+        with grahaka_cache_lock:
+            grahaka_cache[email] = grahaka
+    return grahaka
+
+def forget_grahaka(email: str):
+    with grahaka_cache_lock:
+        grahaka_cache.pop(email, None)
+
+# Payloads of verified tokens, keyed by the token's SHA-256 so that raw tokens are not kept.
+# An entry lives for JWT_CACHE_SECONDS at most and never past the token's own expiry.
+JWT_CACHE_SECONDS = 30
+jwt_cache = TLRUCache(maxsize=10_000,
+    ttu=lambda key, payload, now: min(now + JWT_CACHE_SECONDS, payload.get("exp", now)),
+    timer=time.time)
+jwt_cache_lock = threading.Lock()
+
+async def decode_token(token: str):
+    """
+    Verifies the token and returns its payload, from the cache if the token was verified recently.
+    On a miss the signature is checked in the threadpool, leaving the event loop to other requests.
+    Raises PyJWTError like jwt.decode; tokens that fail verification are never cached.
+    Anything not shaped like header.payload.signature is turned away before any hashing.
+    """
+    if token.count(".") != 2:
+        raise jwt.DecodeError("Not enough segments")
+    key = hashlib.sha256(token.encode()).digest()
+    with jwt_cache_lock:
+        payload = jwt_cache.get(key)
+    if payload is None:
+        payload = await run_in_threadpool(jwt.decode, token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
+        with jwt_cache_lock:
+            jwt_cache[key] = payload
+    return payload
+
+# Failed sign-ins as token buckets: a burst of LOGIN_BURST attempts, refilled at LOGIN_RATE per second.
+# One bucket per client address turns floods away before any password hashing, whatever usernames they try;
+# one per username stops guessing at a single account from many addresses.
+LOGIN_BURST = 10
+LOGIN_RATE = 10 / 60
+login_buckets = TTLCache(maxsize=10_000, ttl=LOGIN_BURST / LOGIN_RATE)
+account_buckets = TTLCache(maxsize=10_000, ttl=LOGIN_BURST / LOGIN_RATE)
+
+def login_tokens(buckets, key, now):
+    tokens, last = buckets.get(key, (LOGIN_BURST, now))
+    return min(LOGIN_BURST, tokens + (now - last) * LOGIN_RATE)
+
+def make_etag(*parts):
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+def matches_etag(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match")
+    return bool(if_none_match) and etag in [tag.strip() for tag in if_none_match.split(",")]
+
+# Responses for the logged-in grahaka may be kept by the browser, never by shared caches.
+PRIVATE_HEADERS = {"Cache-Control": "private", "Vary": "Authorization"}
+
+async def grahaka_etag(db: AsyncSession, grahaka: GrahakaIdentity, *parts):
+    """
+    Makes the ETag of the logged-in grahaka's records from the grahaka's row_version.
+    SQLite hands a deleted grahaka's ID to the next one, so the tag also carries a digest of the email,
+    and a record under the same ID but another email counts as gone.
+    The cached identity can outlive the record (see grahaka_cache); once the record is gone, so is access.
+    """
+    version = await crud.get_grahaka_version(db=db, grahaka_id=grahaka.id)
+    if not version or version.email != grahaka.email:
+        forget_grahaka(grahaka.email)
+        raise HTTPException(status_code=401, detail="Granted no access.", headers={"WWW-Authenticate": "Bearer"})
+    email_digest = hashlib.sha256(version.email.encode()).hexdigest()[:16]
+    return make_etag(version.id, email_digest, version.row_version, version.is_active, version.is_admin, *parts)
+
+# Templates are compiled once at import; auto_reload is off, so files are not checked on every render.
+jinja_env = Environment(loader=FileSystemLoader("templates"), auto_reload=False, cache_size=400)
+bimbapatra_template = jinja_env.get_template("bimbapatra.html")
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def limit_login_rate(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    # An attempt is charged up front, so that concurrent guesses cannot all slip through,
+    # and refunded by refund_login_attempt when the sign-in succeeds.
+    client = request.client.host if request.client else None
+    now = time.monotonic()
+    client_tokens = login_tokens(login_buckets, client, now)
+    account_tokens = login_tokens(account_buckets, form_data.username, now)
+    if client_tokens < 1 or account_tokens < 1:
+        raise HTTPException(status_code=429, detail="Received too many sign-in attempts. Try again later.")
+    login_buckets[client] = (client_tokens - 1, now)
+    account_buckets[form_data.username] = (account_tokens - 1, now)
+    return client, form_data.username
+
+def refund_login_attempt(login_key):
+    client, username = login_key
+    now = time.monotonic()
+    login_buckets[client] = (min(LOGIN_BURST, login_tokens(login_buckets, client, now) + 1), now)
+    account_buckets[username] = (min(LOGIN_BURST, login_tokens(account_buckets, username, now) + 1), now)
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+async def release_db(db: AsyncSession):
+    # Hands the connection back to the pool before a handler waits on Firebase, so that slow uploads
+    # and deletes do not hold the pool. The session checks a connection out again on its next query.
+    await db.close()
     
-async def get_current_grahaka(db: Session = Depends(get_db), token: str = Depends(oauth2scheme)):
+async def get_current_grahaka(db: AsyncSession = Depends(get_db), token: str = Depends(oauth2scheme)):
     """
     Decodes the token to get the logged-in grahaka.
     Executes the following steps:
     1. Creates an exception class extending HTTPException.
-    2. Decodes the token and extracts the username (email).
-    3. Checks that the grahaka's record exists in the database.
-    4. Returns the grahaka object or raises an HTTP exception.
+    2. Decodes the token (see decode_token) and extracts the username (email).
+    3. Checks that the grahaka's record exists (see get_grahaka_cached).
+    4. Returns the grahaka's identity or raises an HTTP exception.
     """
     credential_exception = HTTPException(
         status_code=401,
@@ -49,23 +198,27 @@ async def get_current_grahaka(db: Session = Depends(get_db), token: str = Depend
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
+        payload = await decode_token(token)
         username: str = payload.get("sub")
         if not username:
             raise credential_exception
-        grahaka = crud.get_grahaka_by_email(db, username)
+        grahaka = await get_grahaka_cached(db, username)
         if not grahaka:
             raise credential_exception
         return grahaka
-    except JWTError:
+    except PyJWTError:
         raise credential_exception
 
-async def get_current_active_grahaka(grahaka: models.Grahaka = Depends(get_current_grahaka)):
+# The dependencies below call each other directly instead of chaining through Depends,
+# so FastAPI resolves a single dependency per request.
+
+async def get_current_active_grahaka(db: AsyncSession = Depends(get_db), token: str = Depends(oauth2scheme)):
+    grahaka = await get_current_grahaka(db, token)
     if not grahaka.is_active:
         raise HTTPException(status_code=400, detail="Grahaka status inactive.")
     return grahaka
 
-async def get_current_admin(admin: models.Grahaka = Depends(get_current_active_grahaka)):
+async def get_current_admin(db: AsyncSession = Depends(get_db), token: str = Depends(oauth2scheme)):
     """
     Restrict certain path operations by injecting admin via Dependency Injection.
     This requires the following:
@@ -73,13 +226,14 @@ async def get_current_admin(admin: models.Grahaka = Depends(get_current_active_g
     2. Inject admin via Dependency Injection in a restricted path op using get_current_admin function.
     3. That's all! Verify using Swagger docs by logging in as admin, logging out and logging in as grahaka.
     """
+    admin = await get_current_active_grahaka(db, token)
     if not admin.is_admin:
         raise HTTPException(status_code=400, detail="Found no admin privileges to continue.")
     return admin
 
 @app.post("/token", tags=["Security"], summary="Generate token after verifying credentials presented.")
-async def create_JWT_token(*, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db), 
-response: Response):
+async def create_JWT_token(*, form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db), 
+request: Request, response: Response, login_key: tuple = Depends(limit_login_rate)):
     """
     Issue a token when the grahaka signs in with username and password.
     The username and password are passed through a form.
@@ -97,51 +251,67 @@ response: Response):
         So in addition to sending the token generated in the response body, 
         we have set a cookie which is retrieved in token-decoding function.
     """
-    grahaka = authenticate.authenticate_grahaka(db, form_data.username, form_data.password)
+    grahaka = await authenticate.authenticate_grahaka(db, form_data.username, form_data.password)
     if not grahaka:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, 
             detail="Issued no token.",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    refund_login_attempt(login_key)
     token_JWT = authorize.create_access_token(
         data={"sub": form_data.username},
         expires_delta=timedelta(minutes=config.ACCESS_TOKEN_EXPIRES_MINUTES)
     )
-    response.delete_cookie(key="access_token")
-    response.set_cookie(key="access_token_cookie", value=token_JWT)
+    # Clear the cookie of earlier versions only for browsers that still carry it.
+    if "access_token" in request.cookies:
+        response.delete_cookie(key="access_token")
+    response.set_cookie(key="access_token_cookie", value=token_JWT, httponly=True, secure=True, samesite="lax")
     return {"access_token": token_JWT, "token_type": "bearer"}
 
 @app.post("/grahaka/", response_model=schemas.Grahaka, 
 tags=["Grahaka"], 
 summary="Create a new grahaka account.")
-async def add_grahaka(grahaka: schemas.GrahakaCreate, db: Session = Depends(get_db)):
-    grahaka_DB = crud.get_grahaka_by_email(db=db, email=grahaka.email)
-    if grahaka_DB:
+async def add_grahaka(grahaka: schemas.GrahakaCreate, db: AsyncSession = Depends(get_db)):
+    if await crud.exists_grahaka_by_email(db=db, email=grahaka.email):
         raise HTTPException(status_code=400, detail="Already have the grahaka.")
-    return crud.create_grahaka(db=db, grahaka=grahaka)
+    grahaka_DB = await crud.create_grahaka(db=db, grahaka=grahaka)
+    forget_grahaka(grahaka_DB.email)
+    return grahaka_DB
 
 @app.get("/grahaka/", response_model=List[schemas.Grahaka], 
 tags=["Grahaka", "Admin"], 
 summary="Retrieve all grahaka for admin.")
 async def access_grahaka(skip: int=0, limit: int=99, 
-    db: Session = Depends(get_db), 
+    db: AsyncSession = Depends(get_db), 
     admin: schemas.Grahaka = Depends(get_current_admin)):
-    return crud.get_grahaka(db=db, skip=skip, limit=limit)
+    all_grahaka = await crud.get_grahaka(db=db, skip=skip, limit=limit)
+    return ORJSONResponse(schemas.GrahakaList.parse_obj(all_grahaka).dict()["__root__"])
 
 @app.get("/grahaka/me/", response_model=schemas.Grahaka, 
 tags=["Grahaka", "Security"], 
 summary="Who am I?")
-async def access_loggedin_grahaka(grahaka_loggedin: models.Grahaka = Depends(get_current_active_grahaka)):
-    return grahaka_loggedin
+async def access_loggedin_grahaka(request: Request, response: Response,
+    db: AsyncSession = Depends(get_db),
+    grahaka_loggedin: GrahakaIdentity = Depends(get_current_active_grahaka)):
+    """
+    Returns the logged-in grahaka's record with an ETag.
+    Answers 304 Not Modified without loading the record when the client's copy is current.
+    """
+    etag = await grahaka_etag(db, grahaka_loggedin)
+    if matches_etag(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, **PRIVATE_HEADERS})
+    response.headers["ETag"] = etag
+    response.headers.update(PRIVATE_HEADERS)
+    return await crud.get_grahaka_by_ID(db=db, grahaka_id=grahaka_loggedin.id)
 
 @app.get("/grahaka/{ID}", response_model=schemas.Grahaka, 
 tags=["Grahaka", "Admin"], 
 summary="Retrieve grahaka's record by ID for admin.")
 async def access_grahaka_by_ID(ID: int, 
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     admin: schemas.Grahaka = Depends(get_current_admin)):
-    grahaka_DB = crud.get_grahaka_by_ID(db=db, grahaka_id=ID)
+    grahaka_DB = await crud.get_grahaka_by_ID(db=db, grahaka_id=ID)
     if not grahaka_DB:
         raise HTTPException(status_code=404, detail=f"Found no user with {ID}.")
     return grahaka_DB
@@ -150,32 +320,18 @@ async def access_grahaka_by_ID(ID: int,
 tags=["Grahaka", "Admin"], 
 summary="Remove grahaka's account and records with ID for admin.")
 async def remove_grahaka_by_ID(ID: int, 
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     admin: schemas.Grahaka = Depends(get_current_admin)):
 
-    all_patra = crud.get_patra_for_grahaka(db=db, grahaka_id=ID)
-    if all_patra:
-        urls2delete = [this_patra.image for this_patra in all_patra]
-        if urls2delete:
-            try:
-                fire_token = FireCRUD.retrieve_authToken()
-            except HTTPError as errHTTP:
-                raise HTTPException(status_code=404, detail=f'Got no token from Firebase. See: {errHTTP}')
-            except Exception as err:
-                raise HTTPException(status_code=404, detail=f'Got no auth token. See: {err}')
-            else:
-                print(fire_token)
-                for bimba2delete in urls2delete:
-                    headers = {"Authorization": "Bearer "+fire_token["idToken"]}
-                    try:
-                        r = requests.delete(bimba2delete, headers=headers)
-                        r.raise_for_status()
-                    except HTTPError as errHTTP:
-                        raise HTTPException(status_code=404, detail=f'Removed no image from Firebase. See: {errHTTP}.')
-                    except Exception as err:
-                        raise HTTPException(status_code=404, detail=f'Removed no image. See: {err}.')
-
-    return crud.delete_grahaka(db=db, grahaka_id=ID)
+    all_patra = await crud.get_patra_for_grahaka(db=db, grahaka_id=ID)
+    await release_db(db)
+    for this_patra in all_patra:
+        await firebase_io.delete(app.state.http, this_patra.image)
+
+    grahaka_DB = await crud.delete_grahaka(db=db, grahaka_id=ID)
+    if grahaka_DB:
+        forget_grahaka(grahaka_DB.email)
+    return grahaka_DB
 
 @app.post("/grahaka/{ID}/patra/", response_model=schemas.Patra, 
 tags=["Grahaka", "Patra", "Admin"], 
@@ -184,7 +340,7 @@ deprecated=True)
 async def add_patra_for_grahaka(ID: int, patra: schemas.PatraCreate, 
     db = Depends(get_db),
     admin: schemas.Grahaka = Depends(get_current_admin)):
-    return crud.create_patra_for_grahaka(db=db, patra=patra, grahaka_id=ID)
+    return await crud.create_patra_for_grahaka(db=db, patra=patra, grahaka_id=ID)
 
 @app.post("/patra/", response_model=schemas.Patra,
 tags=["Grahaka", "Patra"],
@@ -192,9 +348,9 @@ summary="Upload a patra for the logged-in grahaka.",
 deprecated=True)
 async def upload_patra(
     patra: schemas.PatraCreate,
-    db: Session = Depends(get_db), 
+    db: AsyncSession = Depends(get_db), 
     grahaka: schemas.Grahaka = Depends(get_current_active_grahaka)):
-    return crud.create_patra_for_grahaka(db=db, patra=patra, grahaka_id=grahaka.id)
+    return await crud.create_patra_for_grahaka(db=db, patra=patra, grahaka_id=grahaka.id)
 
 @app.post("/patra_upload/", response_model=schemas.Patra,
 tags=["Grahaka", "Patra"],
@@ -202,7 +358,7 @@ summary="Upload a patra for the logged-in grahaka.")
 async def upload_patra(
     bimba: UploadFile = File(...),
     tags: List[str] = Query(..., description="Furnish tags for searchability."),
-    db: Session = Depends(get_db), 
+    db: AsyncSession = Depends(get_db), 
     grahaka: schemas.Grahaka = Depends(get_current_active_grahaka)):
     """
     Upload a file to grahaka's folder on Firebase. 
@@ -212,44 +368,32 @@ async def upload_patra(
     identified by grahaka's email (since email is unique.)
     Grahaka's content is stored here for privacy and security.
     """
-    try:
-        fire_token = FireCRUD.retrieve_authToken()
-    except HTTPError as errHTTP:
-        raise HTTPException(status_code=404, detail=f'Got no token from Firebase. See: {errHTTP}')
-    except Exception as err:
-        raise HTTPException(status_code=404, detail=f'Got no auth token. See: {err}')
+    if not len(tags) > 1:
+        label = tags[0]
     else:
-        print(fire_token)
-        if not len(tags) > 1:
-            label = tags[0]
-        else:
-            label = ",".join(tags).lower()
-        print(tags)
-        url2fire = 'https://firebasestorage.googleapis.com/v0/b/shiva-923e9.appspot.com/o/stash%2F'
-        url2file = url2fire + quote(grahaka.email, safe='') + "%2F" + bimba.filename.replace(" ", "_")
-        headers = {"Content-Type": bimba.content_type, "Authorization": "Bearer "+fire_token["idToken"]}
-        try:
-            r = requests.post(url2file, data=bimba.file.read(), headers=headers)
-            r.raise_for_status()
-        except HTTPError as errHTTP:
-            raise HTTPException(status_code=404, detail=f'Uploaded no image to Firebase. See: {errHTTP}')
-        except Exception as err:
-            raise HTTPException(status_code=404, detail=f'Posted no image to Firebase. See: {err}')
-        else:           
-            response = r.json()
-            print(response)
-            bimbaURL = url2file + '?alt=media&token=' + response["downloadTokens"]
-            bimbapatra = schemas.PatraCreate(image=bimbaURL, tags=label)
-            
-    return crud.create_patra_for_grahaka(db=db, patra=bimbapatra, grahaka_id=grahaka.id)
+        label = ",".join(tags).lower()
+    logger.debug("Tagging upload with %s.", tags)
+    await release_db(db)
+    bimbaURL = await firebase_io.upload(app.state.http, bimba, grahaka.email)
+    bimbapatra = schemas.PatraCreate(image=bimbaURL, tags=label)
+    return await crud.create_patra_for_grahaka(db=db, patra=bimbapatra, grahaka_id=grahaka.id)
 
 @app.get("/patra/", response_model=List[schemas.Patra], 
 tags=["Patra"], 
 summary="Retrieve records for logged-in grahaka.")
-async def access_patra(skip: int=0, limit: int=99, 
-    db: Session = Depends(get_db), 
+async def access_patra(request: Request, skip: int=0, limit: int=99, 
+    db: AsyncSession = Depends(get_db), 
     grahaka: schemas.Grahaka = Depends(get_current_active_grahaka)):
-    return crud.get_patra_for_grahaka(db=db, grahaka_id=grahaka.id, skip=skip, limit=limit)
+    """
+    Returns a page of the logged-in grahaka's patra with an ETag.
+    Answers 304 Not Modified without loading the page when the client's copy is current.
+    """
+    etag = await grahaka_etag(db, grahaka, skip, limit)
+    if matches_etag(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, **PRIVATE_HEADERS})
+    all_patra = await crud.get_patra_for_grahaka(db=db, grahaka_id=grahaka.id, skip=skip, limit=limit)
+    return ORJSONResponse(schemas.PatraList.parse_obj(all_patra).dict()["__root__"],
+        headers={"ETag": etag, **PRIVATE_HEADERS})
 
 @app.get("/patra/{ID}", response_model=schemas.Patra, 
 tags=["Patra", "Admin"], 
@@ -257,7 +401,7 @@ summary="Retrieve patra by ID for admin.")
 async def access_patra_by_ID(ID: int, 
     db = Depends(get_db),
     admin: schemas.Grahaka = Depends(get_current_admin)):
-    patra_DB = crud.get_patra_by_ID(db=db, patra_id=ID)
+    patra_DB = await crud.get_patra_by_ID(db=db, patra_id=ID)
     if not patra_DB:
         raise HTTPException(status_code=404, detail=f"Found no patra with {ID}")
     return patra_DB
@@ -269,7 +413,7 @@ deprecated=True)
 async def remove_patra_by_ID(ID: int,
     db = Depends(get_db),
     grahaka: schemas.Grahaka = Depends(get_current_active_grahaka)):
-    patra_DB = crud.delete_patra_for_grahaka(db=db, grahaka_id=grahaka.id, patra_id=ID)
+    patra_DB = await crud.delete_patra_for_grahaka(db=db, grahaka_id=grahaka.id, patra_id=ID)
     if not patra_DB:
         raise HTTPException(status_code=404, detail=f"Found no patra with {ID}")
     return patra_DB
@@ -280,30 +424,16 @@ summary="Delete a patra by ID for the logged-in grahaka or admin.")
 async def remove_patra_by_ID(ID: int,
     db = Depends(get_db),
     grahaka: schemas.Grahaka = Depends(get_current_active_grahaka)):
-    patra_DB = crud.get_patra_by_ID(db=db, patra_id=ID)
+    patra_DB = await crud.get_patra_for_deletion(db=db, patra_id=ID, grahaka_id=grahaka.id, is_admin=grahaka.is_admin)
     if not patra_DB:
-        raise HTTPException(status_code=404, detail=f"Found no patra {ID}.")
-    if not (patra_DB.owner_id == grahaka.id or grahaka.is_admin):
-        raise HTTPException(status_code=401, detail=f"Grahaka has no right to delete {ID}.")
-    try:
-        fire_token = FireCRUD.retrieve_authToken()
-    except HTTPError as errHTTP:
-        raise HTTPException(status_code=404, detail=f'Got no token from Firebase. See: {errHTTP}')
-    except Exception as err:
-        raise HTTPException(status_code=404, detail=f'Got no auth token. See: {err}')
-    else:
-        print(fire_token)
-        bimba2delete = patra_DB.image
-        headers = {"Authorization": "Bearer "+fire_token["idToken"]}
-        try:
-            r = requests.delete(bimba2delete, headers=headers)
-            r.raise_for_status()
-        except HTTPError as errHTTP:
-            raise HTTPException(status_code=404, detail=f'Removed no image from Firebase. See: {errHTTP}.')
-        except Exception as err:
-            raise HTTPException(status_code=404, detail=f'Removed no image. See: {err}.')
-    
-    return crud.delete_patra(db=db, patra_id=ID)
+        raise HTTPException(status_code=404, detail=f"Found no patra {ID} that grahaka may delete.")
+    # The record is deleted only once its image is gone, so a failure leaves both in place.
+    await release_db(db)
+    await firebase_io.delete(app.state.http, patra_DB.image)
+    patra_DB = await crud.fetch_and_delete_patra(db=db, patra_id=ID, grahaka_id=grahaka.id, is_admin=grahaka.is_admin)
+    if not patra_DB:
+        raise HTTPException(status_code=404, detail=f"Found no patra {ID} that grahaka may delete.")
+    return patra_DB
     
 @app.delete("/patra_dosh/{ID}", response_model=schemas.Patra,
 tags=["Patra", "Admin"],
@@ -312,7 +442,7 @@ deprecated=True)
 async def remove_patra_admin(ID: int,
     db = Depends(get_db),
     admin: schemas.Grahaka = Depends(get_current_admin)):
-    patra_DB = crud.delete_patra(db=db, patra_id=ID)
+    patra_DB = await crud.delete_patra(db=db, patra_id=ID)
     if not patra_DB:
         raise HTTPException(status_code=404, detail=f"Found no patra with {ID}")
     return patra_DB
@@ -342,62 +472,54 @@ async def html_form_auth():
     """
     return HTMLResponse(content=form_body)
 
-async def get_cookie_grahaka(db: Session = Depends(get_db), access_token_cookie: str = Cookie(None)):
+async def get_cookie_grahaka(db: AsyncSession = Depends(get_db), access_token_cookie: str = Cookie(None)):
     """
     Accepts token as cookie and decodes it to get the logged-in grahaka.
     Executes the following steps:
     1. Creates an exception class extending HTTPException.
-    2. Decodes the token and extracts the username (email).
-    3. Checks that the grahaka's record exists in the database.
-    4. Returns the grahaka object or raises an HTTP exception.
+    2. Decodes the token (see decode_token) and extracts the username (email).
+    3. Checks that the grahaka's record exists (see get_grahaka_cached).
+    4. Returns the grahaka's identity or raises an HTTP exception.
     """
     credential_exception = HTTPException(
         status_code=401,
         detail="Granted no access.",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    if not access_token_cookie:
+        raise credential_exception
     try:
-        payload = jwt.decode(access_token_cookie, config.SECRET_KEY, algorithms=[config.ALGORITHM])
+        payload = await decode_token(access_token_cookie)
         username: str = payload.get("sub")
         if not username:
             raise credential_exception
-        grahaka = crud.get_grahaka_by_email(db, username)
+        grahaka = await get_grahaka_cached(db, username)
         if not grahaka:
             raise credential_exception
         return grahaka
-    except JWTError:
+    except PyJWTError:
         raise credential_exception
 
 
 @app.get("/web_patra", tags=["Web: Limited Feature"])
 async def access_patra_by_tags(skip: int=0, limit: int=99,
     q: Optional[List[str]] = Query(None, description="Enter as many or as few tags as you desire."),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     grahaka: schemas.Grahaka = Depends(get_cookie_grahaka)):
     """
     SPECIAL CASE FOR VIEWING IN BROWSER.
     The graghaka will need to /sign-in from the browser.
     The 
     """
-    search_scope = crud.get_patra_for_grahaka(db=db, grahaka_id=grahaka.id, skip=skip, limit=limit)
+    if q:
+        search_scope = await crud.get_patra_for_grahaka_by_tags(db=db, grahaka_id=grahaka.id, tags=q,
+            skip=skip, limit=limit)
+    else:
+        search_scope = await crud.get_patra_for_grahaka(db=db, grahaka_id=grahaka.id, skip=skip, limit=limit)
     if not search_scope:
         HTTPException(status_code=404, detail="Found not matching results.")
-    if q:
-        search_terms = q
-        while True:
-            search_term = search_terms.pop()
-            matches = [record for record in search_scope if search_term in record.tags.split(",")]
-            search_scope = matches
-            if len(matches) == 0:
-                break
-            if len(search_terms) == 0:
-                break
     
     # Jinja-fy!
-    file_loader = FileSystemLoader("templates")
-    env = Environment(loader=file_loader)
-
-    template = env.get_template("bimbapatra.html")
-    output_html = template.render(records=search_scope)
+    output_html = bimbapatra_template.render(records=search_scope)
 
     return HTMLResponse(content=output_html) # search_scope
\ No newline at end of file
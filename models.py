@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Boolean, String, Integer, ForeignKey
+from sqlalchemy import Column, Boolean, String, Integer, ForeignKey, Index, inspect, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import relationship
+from sqlalchemy.schema import CreateTable, CreateIndex
 
 import database
 from database import Base
@@ -12,10 +14,15 @@ class Grahaka(Base):
     password_hashed = Column(String)
     is_active = Column(Boolean)
     is_admin = Column(Boolean)
+    # Bumped whenever the grahaka's patra change; see crud.py. Used for ETags.
+    row_version = Column(Integer, nullable=False, default=0, server_default="0")
 
+    # Never loaded implicitly: queries that serialize items ask for them with selectinload (see crud.py),
+    # and any other access fails loudly instead of issuing a SELECT per grahaka.
     items = relationship("Patra", 
         back_populates="owner",
-        cascade="all, delete, delete-orphan")
+        cascade="all, delete, delete-orphan",
+        lazy="raise")
 
 class Patra(Base):
     __tablename__ = 'patra'
@@ -24,7 +31,64 @@ class Patra(Base):
     image = Column(String)
     document = Column(String)
     tags = Column(String)
-    owner_id = Column(Integer, ForeignKey('grahaka.id'))
+    owner_id = Column(Integer, ForeignKey('grahaka.id', ondelete='CASCADE'))
 
     owner = relationship("Grahaka", back_populates="items")
 
+    __table_args__ = (
+        Index('ix_patra_owner_id_id', 'owner_id', 'id'),
+    )
+
+class PatraTag(Base):
+    # Each tag of a patra on its own row, so that a search by tag is an index seek.
+    # Kept in step with Patra.tags by crud.py.
+    __tablename__ = 'patra_tag'
+
+    patra_id = Column(Integer, ForeignKey('patra.id', ondelete='CASCADE'), primary_key=True)
+    tag = Column(String, primary_key=True)
+
+    __table_args__ = (
+        Index('ix_patra_tag_tag_patra_id', 'tag', 'patra_id'),
+    )
+
+def split_tags(tags):
+    # The tags of a patra as the web search has always read them: comma-separated, matched exactly.
+    return list(dict.fromkeys(tags.split(","))) if tags is not None else []
+
+def add_missing_columns(conn):
+    # create_all leaves existing tables alone, so add columns introduced since the table was made.
+    columns = {column["name"] for column in inspect(conn).get_columns("grahaka")}
+    if "row_version" not in columns:
+        try:
+            conn.execute(text("ALTER TABLE grahaka ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0"))
+        except OperationalError as err:
+            # Another worker starting at the same time added it first.
+            if "duplicate column" not in str(err):
+                raise
+
+def fill_patra_tags(conn):
+    # Tag rows for patra stored before the patra_tag table existed.
+    # Rows another worker starting at the same time has already written are skipped.
+    if conn.execute(text("SELECT 1 FROM patra_tag LIMIT 1")).first():
+        return
+    rows = [{"patra_id": patra_id, "tag": tag}
+        for patra_id, tags in conn.execute(text("SELECT id, tags FROM patra")) for tag in split_tags(tags)]
+    if rows:
+        conn.execute(PatraTag.__table__.insert().prefix_with("OR IGNORE"), rows)
+
+def migrate(conn):
+    """
+    Brings a database made by an earlier version up to date. Runs on every startup,
+    whether or not create_all does, and every step is safe to repeat.
+    Executes the steps as follows:
+    1. Adds the row_version column to grahaka.
+    2. Creates the patra_tag table and the indexes introduced since the tables were made.
+    3. Fills patra_tag for patra stored before it existed.
+    """
+    if not inspect(conn).has_table("grahaka"):
+        return
+    add_missing_columns(conn)
+    conn.execute(CreateTable(PatraTag.__table__, if_not_exists=True))
+    for index in [*Patra.__table__.indexes, *PatraTag.__table__.indexes]:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+    fill_patra_tags(conn)
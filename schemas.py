@@ -37,3 +37,12 @@ class Grahaka(GrahakaBase):
     class Config:
         orm_mode=True
 
+# List wrappers, built once, that validate a whole page of rows in one pass.
+# Path operations hand their output straight to ORJSONResponse,
+# so FastAPI does not validate and encode the list again.
+
+class PatraList(BaseModel):
+    __root__: List[Patra]
+
+class GrahakaList(BaseModel):
+    __root__: List[Grahaka]